@@ -1,4 +1,10 @@
+from contextlib import contextmanager
+import os
+import Queue
 import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -58,6 +64,118 @@ class GTDTDbRowSet(GTDTDbRow):
         self.controller.delete(self.table, **kwargs)
 
 
+class GTDTPool(object):
+    """ Thread-safe pool of connections to the GTDTogether database.
+
+        Each thread checks out its own connection (nested checkouts on
+        one thread share it), at most `size` are open at once, and
+        statements are retried with backoff whilst another writer holds
+        the database lock.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path='db.sqlite', size=5, timeout=5.0, retries=5):
+        self.path = path
+        self.timeout = timeout
+        self.retries = retries
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = Queue.LifoQueue()
+        self._local = threading.local()
+
+    @classmethod
+    def shared(cls, **kwargs):
+        """ The process-wide pool, created with `kwargs` on first use. """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**kwargs)
+            return cls._shared
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _retry(self, func, *args):
+        """ Call `func`, retrying whilst the database is locked. """
+        delay = 0.05
+        for attempt in xrange(self.retries):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e) or attempt == self.retries - 1:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+
+    @contextmanager
+    def connection(self):
+        """ Check out a connection for the current thread. Anything
+            left uncommitted when it is returned is rolled back.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                conn = self._connect()
+            self._local.conn = conn
+            self._local.transaction = False
+            try:
+                yield conn
+            finally:
+                self._local.conn = None
+                conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """ Group statements on this thread into a single commit. """
+        with self.connection() as conn:
+            if self._local.transaction:
+                yield conn
+                return
+            self._local.transaction = True
+            try:
+                yield conn
+                self._retry(conn.commit)
+            except:
+                conn.rollback()
+                raise
+            finally:
+                self._local.transaction = False
+
+    def execute(self, query, params=()):
+        """ Execute a statement, committing it unless inside a
+            `transaction`. Returns the cursor's lastrowid.
+        """
+        with self.connection() as conn:
+            cursor = self._retry(conn.execute, query, params)
+            if not self._local.transaction:
+                self._retry(conn.commit)
+            return cursor.lastrowid
+
+    def executemany(self, query, seq):
+        """ Execute a statement for each set of parameters in `seq`,
+            committing them unless inside a `transaction`.
+        """
+        with self.connection() as conn:
+            self._retry(conn.executemany, query, seq)
+            if not self._local.transaction:
+                self._retry(conn.commit)
+
+    def query(self, query, params=()):
+        """ Execute a query and return all rows. """
+        with self.connection() as conn:
+            return self._retry(lambda: conn.execute(query, params).fetchall())
+
+
 class GTDTDb(object):
     """ Basic ORM for the GTDTogether Database. """
     tables = {
@@ -65,10 +183,12 @@ class GTDTDb(object):
         'tracked_tasks': GTDTDbRowSet,
     }
 
-    def __init__(self, username):
+    def __init__(self, username, pool=None):
+        """ A lightweight per-user view over `pool`
+            (by default the shared `GTDTPool`).
+        """
         self.username = username
-        self.conn = sqlite3.connect('db.sqlite')
-        self.conn.row_factory = sqlite3.Row
+        self.pool = pool or GTDTPool.shared()
         for table, cls in GTDTDb.tables.iteritems():
             setattr(self, table, cls(self, table, self.fetchall(table, 'rowid')))
 
@@ -76,53 +196,168 @@ class GTDTDb(object):
         if kwargs.has_key('rowid'):
             del(kwargs['rowid'])
         kwargs['username'] = self.username
-        cursor = self.conn.cursor()
         cols = ', '.join(kwargs.iterkeys())
         values = ', '.join('?' for value in range(len(kwargs)))
-        cursor.execute('INSERT INTO %s (%s) VALUES (%s)' % (table, cols, values), kwargs.values())
-        cursor.close()
-        self.conn.commit()
-        return cursor.lastrowid
+        return self.pool.execute('INSERT INTO %s (%s) VALUES (%s)' % (table, cols, values), kwargs.values())
 
     def update(self, table, rowid, col, value):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE %s SET %s=? WHERE rowid=? AND username=?' % (table, col), (value, rowid, self.username))
-        cursor.close()
-        self.conn.commit()
+        self.pool.execute('UPDATE %s SET %s=? WHERE rowid=? AND username=?' % (table, col), (value, rowid, self.username))
 
     def delete(self, table, **kwargs):
         kwargs['username'] = self.username
-        cursor = self.conn.cursor()
         query = 'DELETE FROM %s WHERE %s' % (table, ' AND '.join('%s=?' % col for col in kwargs.iterkeys()))
-        cursor.execute(query, kwargs.values())
-        self.conn.commit()
+        self.pool.execute(query, kwargs.values())
 
     def rowcount(self, table, rowid=None):
-        cursor = self.conn.cursor()
         query = 'SELECT COUNT(username) AS rowcount FROM %s WHERE username=?' % table
         params = (self.username,)
         if rowid:
-            query = '%s AND rowid=?'
+            query = '%s AND rowid=?' % query
             params = params + (rowid,)
-        cursor.execute(query, params)
-        return int(cursor.fetchone()['rowcount'])
+        return int(self.pool.query(query, params)[0]['rowcount'])
 
     def fetch(self, table, rowid, col):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT %s FROM %s WHERE rowid=? AND username=? LIMIT 1' % (col, table), (rowid, self.username,))
-        return cursor.fetchone()[col]
+        return self.pool.query('SELECT %s FROM %s WHERE rowid=? AND username=? LIMIT 1' % (col, table), (rowid, self.username,))[0][col]
 
     def fetchall(self, table, col):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT %s FROM %s WHERE USERNAME=?' % (col, table), (self.username,))
-        return (row[col] for row in cursor.fetchall())
+        return (row[col] for row in self.pool.query('SELECT %s FROM %s WHERE USERNAME=?' % (col, table), (self.username,)))
 
     def purge(self):
-        cursor = self.conn.cursor()
-        for table in GTDTDb.tables.iterkeys():
-            cursor.execute('DELETE FROM %s WHERE username=?' % table, (self.username,))
-        cursor.close()
-        self.conn.commit()
+        with self.pool.transaction():
+            for table in GTDTDb.tables.iterkeys():
+                self.pool.execute('DELETE FROM %s WHERE username=?' % table, (self.username,))
+
+
+class GTDTProjection(object):
+    """ Indexed SQLite mirror of a user's merged OmniFocus tree.
+
+        Rows are stamped with the tail id they reflect, so lookups by
+        id, name, parent or context can be answered from disk without
+        loading the OmniFocus database.
+    """
+    tables = {
+        'of_tasks': ('id', 'name', 'parent', 'context', 'completed'),
+        'of_projects': ('id', 'name', 'folder', 'status'),
+        'of_contexts': ('id', 'name', 'parent'),
+        'of_folders': ('id', 'name', 'parent'),
+    }
+    indexes = ('name', 'parent', 'context', 'folder')
+
+    def __init__(self, username, pool=None):
+        self.username = username
+        self.pool = pool or GTDTPool.shared()
+        self._create()
+
+    def _create(self):
+        with self.pool.transaction():
+            for table, cols in GTDTProjection.tables.iteritems():
+                self.pool.execute('CREATE TABLE IF NOT EXISTS %s (username TEXT NOT NULL, %s, PRIMARY KEY (username, id))' % (table, ', '.join('%s TEXT' % col for col in cols)))
+                for col in cols:
+                    if col in GTDTProjection.indexes:
+                        self.pool.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (username, %s)' % (table, col, table, col))
+            self.pool.execute('CREATE TABLE IF NOT EXISTS of_projection (username TEXT PRIMARY KEY, tail_id TEXT)')
+
+    @property
+    def tail_id(self):
+        """ The tail id the projection currently reflects. """
+        rows = self.pool.query('SELECT tail_id FROM of_projection WHERE username=?', (self.username,))
+        return rows[0]['tail_id'] if rows else None
+
+    def batch(self):
+        """ Group updates (and their `stamp`) into a single commit.
+                `with projection.batch(): projection.upsert(...)`
+        """
+        return self.pool.transaction()
+
+    def stamp(self, tail_id):
+        """ Record the tail id the projection reflects. """
+        self.pool.execute('INSERT OR REPLACE INTO of_projection (username, tail_id) VALUES (?, ?)', (self.username, tail_id))
+
+    def reset(self):
+        """ Remove all projected rows, ready for a full rebuild. """
+        with self.pool.transaction():
+            for table in GTDTProjection.tables.iterkeys():
+                self.pool.execute('DELETE FROM %s WHERE username=?' % table, (self.username,))
+            self.pool.execute('DELETE FROM of_projection WHERE username=?', (self.username,))
+
+    def upsert(self, table, **kwargs):
+        """ Insert or replace a row. """
+        kwargs['username'] = self.username
+        cols = ', '.join(kwargs.iterkeys())
+        values = ', '.join('?' for value in range(len(kwargs)))
+        self.pool.execute('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (table, cols, values), kwargs.values())
+
+    def remove(self, table, id):
+        """ Remove a row. """
+        self.pool.execute('DELETE FROM %s WHERE username=? AND id=?' % table, (self.username, id))
+
+    def upsert_many(self, table, rows):
+        """ Insert or replace a list of rows, given as dicts with the same keys. """
+        if not rows:
+            return
+        cols = list(rows[0].iterkeys())
+        query = 'INSERT OR REPLACE INTO %s (username, %s) VALUES (?, %s)' % (table, ', '.join(cols), ', '.join('?' for col in cols))
+        self.pool.executemany(query, [[self.username] + [row[col] for col in cols] for row in rows])
+
+    def remove_many(self, table, ids):
+        """ Remove the rows with each of `ids`. """
+        self.pool.executemany('DELETE FROM %s WHERE username=? AND id=?' % table, [(self.username, id) for id in ids])
+
+    def get(self, table, id):
+        """ Fetch a single row by id, or `None`. """
+        rows = self.filter(table, id=id)
+        return rows[0] if rows else None
+
+    def filter(self, table, **kwargs):
+        """ Fetch all rows matching every `col=value` given.
+                `projection.filter('of_tasks', context='ctx_id')`
+        """
+        kwargs['username'] = self.username
+        query = 'SELECT * FROM %s WHERE %s' % (table, ' AND '.join('%s=?' % col for col in kwargs.iterkeys()))
+        return self.pool.query(query, kwargs.values())
+
+
+class GTDTPoolTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.pool = GTDTPool(self.path, size=2)
+        self.pool.execute('CREATE TABLE pool_test (value INTEGER)')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def count(self):
+        return self.pool.query('SELECT COUNT(*) AS count FROM pool_test')[0]['count']
+
+    def test_connection(self):
+        with self.pool.connection() as outer:
+            with self.pool.connection() as inner:
+                self.assertTrue(outer is inner)
+
+    def test_threads(self):
+        def worker():
+            for value in range(10):
+                self.pool.execute('INSERT INTO pool_test (value) VALUES (?)', (value,))
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.count(), 80)
+
+    def test_transaction(self):
+        try:
+            with self.pool.transaction():
+                self.pool.execute('INSERT INTO pool_test (value) VALUES (1)')
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(self.count(), 0)
+        with self.pool.transaction():
+            self.pool.execute('INSERT INTO pool_test (value) VALUES (1)')
+            self.pool.execute('INSERT INTO pool_test (value) VALUES (2)')
+        self.assertEqual(self.count(), 2)
 
 
 class GTDTDbTest(unittest.TestCase):
@@ -161,5 +396,49 @@ class GTDTDbTest(unittest.TestCase):
         self.assertEqual(len(self.sql.tracked_tasks), 3)
 
 
+class GTDTProjectionTest(unittest.TestCase):
+    def setUp(self):
+        self.projection = GTDTProjection('_test')
+
+    def tearDown(self):
+        self.projection.reset()
+
+    def test_stamp(self):
+        self.assertEqual(self.projection.tail_id, None)
+        self.projection.stamp('tail_id')
+        self.assertEqual(self.projection.tail_id, 'tail_id')
+        self.projection.reset()
+        self.assertEqual(self.projection.tail_id, None)
+
+    def test_upsert(self):
+        self.projection.upsert('of_tasks', id='task_id', name='Task', context='ctx_id')
+        self.projection.upsert('of_tasks', id='task_id', name='Renamed', context='ctx_id')
+        self.assertEqual(self.projection.get('of_tasks', 'task_id')['name'], 'Renamed')
+        self.assertEqual(len(self.projection.filter('of_tasks', context='ctx_id')), 1)
+
+    def test_remove(self):
+        self.projection.upsert('of_contexts', id='ctx_id', name='Context')
+        self.projection.remove('of_contexts', 'ctx_id')
+        self.assertEqual(self.projection.get('of_contexts', 'ctx_id'), None)
+
+    def test_many(self):
+        self.projection.upsert_many('of_contexts', [dict(id='ctx_id', name='Context', parent=None),
+                                                    dict(id='ctx_id2', name='Context 2', parent='ctx_id')])
+        self.assertEqual(self.projection.get('of_contexts', 'ctx_id2')['parent'], 'ctx_id')
+        self.projection.remove_many('of_contexts', ['ctx_id', 'ctx_id2'])
+        self.assertEqual(self.projection.filter('of_contexts'), [])
+
+    def test_batch(self):
+        try:
+            with self.projection.batch():
+                self.projection.upsert('of_folders', id='folder_id', name='Folder')
+                self.projection.stamp('tail_id')
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(self.projection.get('of_folders', 'folder_id'), None)
+        self.assertEqual(self.projection.tail_id, None)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,17 +15,19 @@
     * `OmniDb.insert` is still not "update aware".
     * Major issues with `OmniDelegateContext`'s `type`, `parent` and `root` methods
 """
+from contextlib import contextmanager
 from copy import copy
+from cStringIO import StringIO
 from datetime import datetime
-from glob import glob
-import plistlib
+import hashlib
+import os
 import string
+import sys
 import random
-from zipfile import ZipFile
-
-from lxml import etree, objectify
-
-from gtdt import GTDTDb
+import shutil
+import tempfile
+import threading
+import time
 
 
 class OmniDate(datetime):
@@ -113,15 +115,196 @@ class OmniNode(object):
         return (self.project is not None)
 
 
+class OmniDeltaCache(object):
+    """ On-disk LRU cache of inflated delta files.
+
+        Delta files are immutable once written, so each is only inflated
+        once; afterwards its contents.xml is stored uncompressed and with
+        the blank text already removed, keyed by filename, size and mtime,
+        and parsed from memory in a single call.  Entries are touched on
+        each hit and the least recently used are evicted once `limit`
+        bytes is exceeded.
+
+        Disabled by default, see `OmniDb.cache` and `main.py --cache`.
+    """
+    version = 2
+
+    def __init__(self, path='cache/deltas', limit=64 * 1024 * 1024):
+        self.path = path
+        self.limit = limit
+
+    @staticmethod
+    def read(fn):
+        """ Parse the contents.xml of delta file `fn`, bypassing the cache. """
+        from zipfile import ZipFile
+        from lxml import objectify
+        return objectify.parse(ZipFile(fn).open('contents.xml'), objectify.makeparser(remove_blank_text=True))
+
+    def parse(self, fn):
+        """ Return the contents.xml of delta file `fn` as a tree,
+            from the cache if possible.
+        """
+        from lxml import etree, objectify
+        entry = self._entry(fn)
+        try:
+            f = open(entry, 'rb')
+        except IOError:
+            return self._store(fn, entry)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        os.utime(entry, None)
+        return etree.ElementTree(objectify.fromstring(data, objectify.makeparser(remove_blank_text=True)))
+
+    def _entry(self, fn):
+        """ The cache filename for the current version of `fn`. """
+        st = os.stat(fn)
+        key = '%s:%s:%d:%r' % (self.version, os.path.abspath(fn), st.st_size, st.st_mtime)
+        return '%s/%s' % (self.path, hashlib.sha1(key).hexdigest())
+
+    def _store(self, fn, entry):
+        """ Parse `fn` and write it to the cache as `entry`. """
+        from lxml import etree
+        tree = self.read(fn)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(etree.tostring(tree))
+        finally:
+            f.close()
+        os.rename(tmp, entry)
+        self._evict()
+        return tree
+
+    def _evict(self):
+        """ Remove the least recently used entries until within `limit`. """
+        entries = []
+        for fn in os.listdir(self.path):
+            if fn.startswith('.'):
+                continue
+            try:
+                st = os.stat('%s/%s' % (self.path, fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+        total = sum(size for mtime, size, fn in entries)
+        for mtime, size, fn in sorted(entries):
+            if total <= self.limit:
+                break
+            try:
+                os.remove('%s/%s' % (self.path, fn))
+            except OSError:
+                pass
+            total -= size
+
+
+class OmniEvent(object):
+    """ A single change merged from a delta file.
+
+        `kind` is one of 'added', 'updated', 'moved' or 'deleted'.
+        `el` is the merged element (the op=delete element for deletions)
+        and `orig` the element it replaced, if known.  Both `kind` and
+        `fields` are only worked out when asked for.
+    """
+    # child elements which place a node in the heirarchy
+    _placement = {
+        'folder': ('folder',),
+        'context': ('context',),
+        'task': ('task', 'context', 'project/folder'),
+    }
+
+    def __init__(self, node_type, op, el, orig):
+        self.node_type = node_type
+        self.op = op
+        self.el = el
+        self.orig = orig
+        self._fields = None
+
+    def __repr__(self):
+        return '<OmniEvent %s %s %s>' % (self.kind, self.node_type, self.id)
+
+    @property
+    def id(self):
+        return self.el.get('id')
+
+    @property
+    def kind(self):
+        if self.op is None:
+            return 'added'
+        if self.op == 'delete':
+            return 'deleted'
+        if self.orig is not None and self._refs(self.el) != self._refs(self.orig):
+            return 'moved'
+        return 'updated'
+
+    @property
+    def fields(self):
+        """ The names of the child elements which differ from `orig`
+            (all of them for an element without one).
+        """
+        if self._fields is None:
+            new, old = self._children(self.el), self._children(self.orig)
+            self._fields = sorted(tag for tag in set(new) | set(old) if new.get(tag) != old.get(tag))
+        return self._fields
+
+    def _refs(self, el):
+        """ The idrefs placing `el` in the heirarchy. """
+        refs = []
+        for path in OmniEvent._placement[self.node_type]:
+            child = el
+            for tag in path.split('/'):
+                child = getattr(child, tag, None)
+            refs.append(child.get('idref') if child is not None else None)
+        return refs
+
+    def _children(self, el):
+        """ {tag: value} for each child of `el`. """
+        from lxml import etree
+        if el is None:
+            return {}
+        return dict((etree.QName(child).localname, self._value(child)) for child in el.iterchildren())
+
+    def _value(self, el):
+        """ Comparable text, attributes and children of `el`, ignoring
+            namespace prefixes and objectify's type annotations.
+        """
+        attrib = sorted((key, value) for key, value in el.attrib.items() if not key.startswith('{http://codespeak.net/'))
+        return (el.text, attrib, [self._value(child) for child in el.iterchildren()])
+
+
 class OmniDb(object):
-    def __init__(self, username, client):
-        self.path = 'dbs/%s/OmniFocus.ofocus' % username
+    # node type => projection tables (see `GTDTProjection`)
+    _projected = {
+        'folder': ('of_folders',),
+        'context': ('of_contexts',),
+        'task': ('of_tasks', 'of_projects'),
+    }
+    # an `OmniDeltaCache` shared by all instances, or `None` to always
+    # parse from the zip (the default)
+    cache = None
+
+    def __init__(self, username, client, projection=None):
+        self.storage = client.storage
+        self.path = self.storage.path
         self.username = username
         self._client = client
+        self._projection = projection
         self._tail_id = None
         self._main = None
         self._delta = None
+        # (node_type, op, el, orig) for each change merged since our last sync
+        self._merged = None
+        # projection rows collected whilst loading, see `_write_projection`
+        self._rows = None
+        self._subscribers = []
         self._changes = []
+        # inverse operations for `self._changes`, as (func, args)
+        self._undo = []
+        # (len(self._undo), len(self._changes)) for each open transaction
+        self._savepoints = []
         self._load()
 
     @property
@@ -133,52 +316,117 @@ class OmniDb(object):
 
     @property
     def delta(self):
-        if self._delta is None:
+        """ The changes merged since our last sync as an <omnifocus /> tree,
+            built on first access; `events` avoids building any XML.
+        """
+        if self._merged is None:
             raise OmniDb.NotReady
+        if self._delta is None:
+            self._delta = self.create_root()
+            for node_type, op, el, orig in self._merged:
+                change = copy(el)
+                if op is not None:
+                    change.attrib['op'] = op
+                self._delta.append(change)
         return self._delta
 
     def _load(self):
         main, deltas = [], []; stack = main
-        self._tail_id = self._client.head_id
-        # filename format: (timestamp|0000…)=(head_id)+(tail_id).zip
-        next_file = lambda: '%s/*=%s+*.zip' % (self.path, self._tail_id)
-        get_tail_id = lambda fn: fn.split('/')[-1].split('+')[1].split('.')[0]
+        metadata = self._client.metadata
+        client_tail_id = self._client.tail_id
+        self._tail_id = metadata.head_id
+        # only project trees newer than the tail the projection already reflects,
+        # or everything if that tail is no longer in the chain
+        projection = self._projection
+        if projection is not None:
+            projected_id = projection.tail_id
+            project = projected_id not in [tail_id for fn, tail_id in metadata.chain]
+        else:
+            projected_id, project = None, False
         # iterate over the tail_ids
-        matches = glob(next_file())
-        while matches:
-            fn = matches[0]
+        for fn, tail_id in metadata.chain:
             # 'objectify' the xml and append it to the appropriate stack
-            stack.append(objectify.parse(ZipFile(fn).open('contents.xml'), etree.XMLParser(remove_blank_text=True)))
-            self._tail_id = get_tail_id(fn)
-            if self._tail_id == self._client.tail_id:
+            stack.append((self._parse('%s/%s' % (self.path, fn)), project))
+            self._tail_id = tail_id
+            if self._tail_id == client_tail_id:
                 # if this is the last tail_id we have seen, start building `delta`
                 stack = deltas
-            matches = glob(next_file())
-        self._main = main.pop(0)
-        # merge `main` and `deltas` into one tree at `self.root` and `self.delta` respectively
-        for tree in main:
-            self._merge_delta(tree)
-        self._delta = self.create_root()
-        for tree in deltas:
-            self._merge_delta(tree, self._delta)
-        # merge `self.delta` into `self.root` (for continuity) but keep `self.delta` populated
-        self._merge_delta(self.delta)
-
-    def _merge_delta(self, delta, base=None):
-        """ Merge `delta` into `base`. """
+            if projection is not None and self._tail_id == projected_id:
+                project = True
+        self._main, project = main.pop(0)
+        # {(table, id): row or `None` to remove}, written once merging is done
+        self._rows = {}
+        rebuild = project
+        if rebuild:
+            for node_type in OmniDb._projected.iterkeys():
+                for el in self._xpath('/of:omnifocus/of:%s' % node_type):
+                    self._project(node_type, el, None)
+        # merge `main` and `deltas` into one tree at `self.root`,
+        # recording the changes from `deltas` for `events` and `delta`
+        for tree, project in main:
+            self._merge_delta(tree, project=project)
+        self._delta = None
+        self._merged = []
+        for tree, project in deltas:
+            self._merged.extend(self._merge_delta(tree, project=project))
+        if projection is not None and projected_id != self._tail_id:
+            self._write_projection(rebuild)
+        self._rows = None
+
+    def _write_projection(self, rebuild):
+        """ Write the rows collected by `_project` and our tail id in one
+            short transaction, so the database isn't locked whilst parsing.
+        """
+        upserts, removes = {}, {}
+        for (table, id), row in self._rows.iteritems():
+            if row is None:
+                if not rebuild:
+                    removes.setdefault(table, []).append(id)
+            else:
+                row['id'] = id
+                upserts.setdefault(table, []).append(row)
+        projection = self._projection
+        with projection.batch():
+            if rebuild:
+                projection.reset()
+            for table, ids in removes.iteritems():
+                projection.remove_many(table, ids)
+            for table, rows in upserts.iteritems():
+                projection.upsert_many(table, rows)
+            projection.stamp(self._tail_id)
+
+    def _parse(self, fn):
+        """ Parse a delta file, via `OmniDb.cache` if enabled. """
+        if OmniDb.cache is None:
+            return OmniDeltaCache.read(fn)
+        return OmniDb.cache.parse(fn)
+
+    def _merge_delta(self, delta, base=None, project=False):
+        """ Merge `delta` into `base`, optionally mirroring
+            each element into `self._projection`.
+
+            Returns `(node_type, op, el, orig)` for each change, where
+            `orig` is the element replaced or deleted (if found).
+        """
         if base is None:
             base = self.root
-        for node_type in ('context', 'task'):
+        changes = []
+        for node_type in ('folder', 'context', 'task'):
             for el in self._xpath('/of:omnifocus/of:%s' % node_type, delta):
                 op = el.attrib.get('op', None)
-                if op == 'update':
-                    # if the task has op=update then replace
-                    # the task element in the db with the new element
+                orig = None
+                if project:
+                    self._project(node_type, el, op)
+                if op is not None:
                     try:
                         orig = self._xpath("/of:omnifocus/of:%s[@id='%s']" % (node_type, el.attrib['id']), base)[0]
-                        base.remove(orig)
                     except IndexError:
                         pass
+                if op == 'update':
+                    # if the task has op=update then replace
+                    # the task element in the db with the new element
+                    if orig is not None:
+                        base.remove(orig)
                     del(el.attrib['op'])
                     base.append(el)
                 elif op is None:
@@ -186,33 +434,89 @@ class OmniDb(object):
                     base.append(el)
                 elif op == 'delete':
                     ## FIXME I suspect this is wrong, and the node is simply marked as deleted
-                    base.remove(el)
+                    if orig is not None:
+                        base.remove(orig)
+                changes.append((node_type, op, el, orig))
+        return changes
+
+    def _project(self, node_type, el, op):
+        """ Collect the projection rows for a single merged element. """
+        id = el.get('id')
+        rows = self._rows
+        if op == 'delete':
+            for table in OmniDb._projected[node_type]:
+                rows[table, id] = None
+            return
+        def text(parent, tag):
+            return getattr(getattr(parent, tag, None), 'text', None)
+        def idref(parent, tag):
+            child = getattr(parent, tag, None)
+            return child.get('idref') if child is not None else None
+        if node_type == 'task':
+            rows['of_tasks', id] = dict(name=text(el, 'name'), parent=idref(el, 'task'),
+                                        context=idref(el, 'context'), completed=text(el, 'completed'))
+            project = getattr(el, 'project', None)
+            if project is not None:
+                rows['of_projects', id] = dict(name=text(el, 'name'), folder=idref(project, 'folder'),
+                                               status=text(project, 'status'))
+            else:
+                rows['of_projects', id] = None
+        else:
+            rows[OmniDb._projected[node_type][0], id] = dict(name=text(el, 'name'), parent=idref(el, node_type))
 
     def _generate_delta(self):
-        """ Generate a delta file for changes
-            and then a client file.
+        """ Generate a delta file for changes and then a client file,
+            unless there are changes we haven't seen (e.g. in a delegatee's
+            database) which our tail id must stay behind until `acknowledge`.
         """
+        from zipfile import ZipFile
+        from lxml import etree
         id = self._generate_id()
         timestamp = OmniDate.now()
-        filename = '%s/%s=%s+%s.zip' % (self.path, timestamp.filename, self._tail_id, id)
+        filename = '%s=%s+%s.zip' % (timestamp.filename, self._tail_id, id)
         delta = self.create_root()
         while self._changes:
             delta.append(self._changes.pop(0))
-        zf = ZipFile(filename, 'w')
+        data = StringIO()
+        zf = ZipFile(data, 'w')
         zf.writestr('contents.xml', etree.tostring(delta, encoding='utf-8', standalone=False))
         zf.close()
-        self._client.generate_file(timestamp, id)
+        self.storage.write(filename, data.getvalue())
+        if self._client.tail_id in (None, self._tail_id):
+            self._client.generate_file(timestamp, id)
+        else:
+            OmniMetadata.expire(self.path)
         self._tail_id = id
 
     def _insert(self, el):
-        """ Insert element directly into `self.root`
-            TODO: check if el.tagName[el.get('id')] exists!
+        """ Insert element directly into `self.root`, replacing any
+            existing element with the same id.
+            Returns the replaced element, or `None`.
         """
-        self.root.append(el)
+        try:
+            orig = self._xpath("/of:omnifocus/*[@id='%s']" % el.get('id'))[0]
+        except IndexError:
+            self.root.append(el)
+            return None
+        if orig is not el:
+            self.root.replace(orig, el)
+        return orig
 
     def _remove(self, el):
         """ Remove an element from `self.root`. """
-        self.root.rmeove(el)
+        self.root.remove(el)
+
+    def _restore(self, el, orig):
+        """ Return `el` to the state of `orig`, a copy taken before it
+            was modified, in place so that other references to it hold.
+        """
+        el.attrib.clear()
+        for name, value in orig.items():
+            el.set(name, value)
+        for child in el.getchildren():
+            el.remove(child)
+        for child in orig.getchildren():
+            el.append(child)
 
     def _xpath(self, query, base=None):
         if base is None:
@@ -236,34 +540,175 @@ class OmniDb(object):
         """ Undo all merged yet uncommitted changes from `main`
             and reload the database upto the last known point.
         """
+        self._changes = []
+        self._undo = []
         self._load()
         return self
 
     def commit(self):
-        """ Commit all changes to the OmniFocus database. """
+        """ Commit all changes to the OmniFocus database.
+            Inside a `transaction` this is deferred until the
+            outermost transaction completes, and with no
+            changes there is nothing to write (or reload).
+        """
+        if self._savepoints or not self._changes:
+            return self
         self._generate_delta()   # generate deltas for `self._changes`
         self.reload()            # reload `self.root` and `self.delta` (incorporating new changes)
         return self
 
+    def rollback(self):
+        """ Undo uncommitted changes in memory, back to the innermost
+            open `transaction` (or all of them outside of one).
+        """
+        undo, changes = self._savepoints[-1] if self._savepoints else (0, 0)
+        while len(self._undo) > undo:
+            func, args = self._undo.pop()
+            func(*args)
+        del(self._changes[changes:])
+        return self
+
+    @contextmanager
+    def transaction(self):
+        """ Group changes so they are committed as a single delta file
+            or, should an exception be raised, undone in memory.
+            Nested transactions act as savepoints.
+                `with db.transaction(): db.insert(el)`
+        """
+        self._savepoints.append((len(self._undo), len(self._changes)))
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        finally:
+            self._savepoints.pop()
+        if not self._savepoints:
+            self.commit()
+
     ## Manipulation Functions
 
     def insert(self, el):
         """ Insert an element into `self.root` and
-            add an appropriate `change`.
+            add an appropriate `change`, op=update if it
+            replaces an existing element.
         """
-        self._insert(el)
-        ## TODO did el exist? op=update or new?
-        self._changes.append(el)
+        if el.getparent() is self.root:
+            # its previous state is already lost, see `update`
+            raise OmniDb.InPlaceChange(el.get('id'))
+        orig = self._insert(el)
+        change = copy(el)
+        if orig is None:
+            self._undo.append((self._remove, (el,)))
+        else:
+            change.attrib['op'] = 'update'
+            self._undo.append((self.root.replace, (el, orig)))
+        self._changes.append(change)
         return self
 
+    @contextmanager
+    def update(self, el):
+        """ Modify an element of `self.root` in place and
+            add an op=update change, keeping a copy of it
+            so the change can be rolled back.
+                `with db.update(task): task.name = 'Renamed'`
+        """
+        orig = copy(el)
+        try:
+            yield el
+        except:
+            self._restore(el, orig)
+            raise
+        change = copy(el)
+        change.attrib['op'] = 'update'
+        self._undo.append((self._restore, (el, orig)))
+        self._changes.append(change)
+
     def remove(self, el):
         """ Remove an element from `self.root` and
             add an op=delete change.
         """
+        index = self.root.index(el)
         self._remove(el)
         delta = copy(el)
         delta.attrib['op'] = 'delete'
-        self._changes.append(el)
+        self._undo.append((self.root.insert, (index, el)))
+        self._changes.append(delta)
+        return self
+
+    def compact(self):
+        """ Fold the delta files up to the oldest tail still in use by
+            any client into a new base file, then delete them.
+            Returns the number of files removed.
+        """
+        from zipfile import ZipFile
+        from lxml import etree
+        metadata = self._client.metadata
+        tail_ids = [tail_id for fn, tail_id in metadata.chain]
+        try:
+            position = tail_ids.index(metadata.oldest_tail_id)
+        except ValueError:
+            return 0
+        if position < 1:
+            return 0
+        fns = [fn for fn, tail_id in metadata.chain[:position + 1]]
+        root = self._parse('%s/%s' % (self.path, fns[0])).getroot()
+        for fn in fns[1:]:
+            self._merge_delta(self._parse('%s/%s' % (self.path, fn)), root)
+        data = StringIO()
+        zf = ZipFile(data, 'w')
+        zf.writestr('contents.xml', etree.tostring(root, encoding='utf-8', standalone=False))
+        zf.close()
+        # the new base is written before anything is removed, so the
+        # chain can be followed from either base in the meantime
+        self.storage.write('00000000000000=%s+%s.zip' % (self._generate_id(), tail_ids[position]), data.getvalue())
+        for fn in fns:
+            self.storage.delete(fn)
+        OmniMetadata.expire(self.path)
+        return len(fns)
+
+    ## Change Events
+
+    def events(self):
+        """ Lazily yield an `OmniEvent` for each change
+            merged since our last sync.
+        """
+        if self._merged is None:
+            raise OmniDb.NotReady
+        for node_type, op, el, orig in self._merged:
+            yield OmniEvent(node_type, op, el, orig)
+
+    def subscribe(self, callback, kinds=None, node_types=None):
+        """ Have `dispatch` call `callback(event)` for each event,
+            optionally only those of the given kinds/node types.
+                `db.subscribe(route, ('added', 'moved'), ('task',))`
+        """
+        self._subscribers.append((callback, kinds, node_types))
+        return self
+
+    def dispatch(self):
+        """ Feed `events` to all subscribers. """
+        for event in self.events():
+            for callback, kinds, node_types in self._subscribers:
+                if node_types is not None and event.node_type not in node_types:
+                    continue
+                if kinds is not None and event.kind not in kinds:
+                    continue
+                callback(event)
+        return self
+
+    def acknowledge(self):
+        """ Record that the changes up to our tail id have been seen,
+            by writing a .client file but no delta, so they aren't
+            parsed again; call once `events` have been dealt with.
+            Never moves the recorded tail id backwards, e.g. past commits
+            made through another `OmniDb` since we were loaded.
+        """
+        metadata = self._client.metadata
+        recorded = metadata.pending(self._client.tail_id)
+        pending = metadata.pending(self._tail_id)
+        if pending is not None and (recorded is None or pending < recorded):
+            self._client.generate_file(OmniDate.now(), self._tail_id)
         return self
 
     ## DB/DOM Query Functions
@@ -352,6 +797,7 @@ class OmniDb(object):
         """ Create a root <omnifocus /> node with all
             the required attributes.
         """
+        from lxml import objectify
         root = objectify.Element('omnifocus')
         root.set('xmlns', 'http://www.omnigroup.com/namespace/OmniFocus/v1')
         root.set('app-id', 'com.omnigroup.OmniFocus')
@@ -363,6 +809,7 @@ class OmniDb(object):
 
     def create_context(self, name, id=None, idref=None, rank=None):
         """ Create a context node """
+        from lxml import objectify
         ctx = objectify.Element('context')
         ctx.set('id', id or self._generate_id())
         if idref:
@@ -387,41 +834,182 @@ class OmniDb(object):
     class ElementNotFound(Exception):
         pass
 
+    class InPlaceChange(Exception):
+        """ Raised by `insert` for an element that is already part of
+            the tree; modify it with `update` instead.
+        """
+        pass
+
+
+class OmniMetadata(object):
+    """ Cached view of the files in an `.ofocus` directory.
+
+        Records the head id, the chain of delta files and the tail
+        identifiers from every client's `.client` file.  The directory
+        is only rescanned when its mtime changes, and a `.client` file
+        is only re-parsed when its own mtime changes.
+    """
+    # {absolute path: metadata}
+    _cache = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.head_id = None
+        # [(filename, tail_id), …] in chain order, starting at the head
+        self.chain = []
+        # {client_id: [tail_id, …]} from each client's latest .client file
+        self.clients = {}
+        self._positions = {}
+        self._mtime = None
+        self._client_files = []
+        self._plists = {}
+
+    @classmethod
+    def get(cls, path):
+        """ Return the shared, up-to-date metadata for `path`. """
+        key = os.path.abspath(path)
+        try:
+            metadata = cls._cache[key]
+        except KeyError:
+            metadata = cls._cache[key] = cls(key)
+        return metadata.refresh()
+
+    @classmethod
+    def expire(cls, path):
+        """ Force the next `get` for `path` to rescan the directory and
+            `.client` files, for changes made within the mtime resolution.
+        """
+        try:
+            metadata = cls._cache[os.path.abspath(path)]
+        except KeyError:
+            return
+        metadata._mtime = None
+        metadata._plists = {}
+
+    def refresh(self):
+        """ Rescan the directory and/or `.client` files if they have changed. """
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._scan()
+        self._read_clients()
+        return self
+
+    def _scan(self):
+        """ Rebuild the delta chain from the directory listing.
+            filename format: (timestamp|0000…)=(head_id)+(tail_id).zip
+        """
+        files = sorted(os.listdir(self.path))
+        links = {}
+        self.head_id = None
+        for fn in files:
+            if not fn.endswith('.zip'):
+                continue
+            timestamp, ids = fn[:-4].split('=', 1)
+            head_id, tail_id = ids.split('+', 1)
+            links.setdefault(head_id, (fn, tail_id))
+            if timestamp == '00000000000000':
+                self.head_id = head_id
+        self.chain = []
+        tail_id = self.head_id
+        while tail_id in links:
+            fn, tail_id = links.pop(tail_id)
+            self.chain.append((fn, tail_id))
+        self._positions = dict((tail_id, i) for i, (fn, tail_id) in enumerate(self.chain))
+        self._client_files = [fn for fn in files if fn.endswith('.client')]
+
+    def _read_clients(self):
+        """ Re-parse any `.client` files which have changed since last read.
+            filename format: (timestamp)=(client_id).client
+        """
+        import plistlib
+        plists = {}
+        for fn in self._client_files:
+            try:
+                st = os.stat('%s/%s' % (self.path, fn))
+            except OSError:
+                # removed since the directory was scanned
+                continue
+            cached = self._plists.get(fn)
+            if cached is None or cached[0] != (st.st_mtime, st.st_size):
+                pl = plistlib.readPlist('%s/%s' % (self.path, fn))
+                cached = ((st.st_mtime, st.st_size), list(pl.get('tailIdentifiers', [])))
+            plists[fn] = cached
+        self._plists = plists
+        # later timestamps sort last, so each client's latest file wins
+        self.clients = dict((fn[:-7].split('=', 1)[1], plists[fn][1]) for fn in sorted(plists))
+
+    def pending(self, tail_id):
+        """ The number of delta files after `tail_id`,
+            or `None` if it isn't in the chain.
+        """
+        try:
+            return len(self.chain) - 1 - self._positions[tail_id]
+        except KeyError:
+            return None
+
+    @property
+    def tip_id(self):
+        """ The tail id at the end of the chain. """
+        if self.chain:
+            return self.chain[-1][1]
+        return self.head_id
+
+    @property
+    def oldest_tail_id(self):
+        """ The earliest tail id (in chain order) that any client still
+            relies upon; everything before it is safe to compact away.
+            Returns `None` if no client has a tail id in the chain.
+        """
+        tail_ids = [tail_id for tail_ids in self.clients.itervalues() for tail_id in tail_ids if tail_id in self._positions]
+        if not tail_ids:
+            return None
+        return min(tail_ids, key=self._positions.get)
+
 
 class OmniClient(object):
     client_id = 'GTDTogether'
     mac_addr = 'de:ad:be:ef:ca:fe'
 
     def __init__(self, sharer):
+        from storage import OmniStorage
         self.sharer = sharer
-        self.path = 'dbs/%s/OmniFocus.ofocus' % sharer.username
+        # remote storage is listed (and anything new fetched) once per
+        # process, or per `OmniStorage.expire`; our own writes keep it current
+        self.storage = OmniStorage.for_user(sharer.username).update()
+        self.path = self.storage.path
+
+    @property
+    def metadata(self):
+        """ The (cached) `OmniMetadata` for our database directory. """
+        return OmniMetadata.get(self.path)
 
     @property
     def head_id(self):
         """ Get the head id of the database.
             0000…=(head)+(tail).zip
         """
-        fn = glob('%s/00000000000000=*.zip' % self.path)[0]
-        return fn.split('/')[-1].split('=')[1].split('+')[0]
+        return self.metadata.head_id
+
+    @property
+    def current(self):
+        """ True if nothing has been added to the chain since we last synced. """
+        return self.tail_id is not None and self.metadata.tip_id == self.tail_id
 
     @property
     def tail_id(self):
         """ Read the tailIdentifier from the last time we synced. """
-        try:
-            fn = glob('%s/*=GTDTogether.client' % self.path)[-1]
-        except IndexError:
+        tail_ids = self.metadata.clients.get(OmniClient.client_id)
+        if tail_ids is None:
             return None
-        pl = plistlib.readPlist(fn)
         try:
-            return pl['tailIdentifiers'][0]
+            return tail_ids[0]
         except IndexError:
             raise Exception
-        except KeyError:
-            raise Exception
-        raise Exception
 
     def generate_file(self, timestamp, id):
         """ Generate a .client file. """
+        import plistlib
         values = {
             'HardwareCPUCount': 2,
             'HardwareCPUType': '7,4',
@@ -439,7 +1027,8 @@ class OmniClient(object):
             'registrationDate': '%sZ' % OmniDate.now().xml,  ## FIXME
             'tailIdentifiers': [id],
         }
-        plistlib.writePlist(values, '%s/%s=%s.client' % (self.sharer.db.path, int(timestamp.filename) + 1, OmniClient.client_id))
+        self.storage.write('%s=%s.client' % (int(timestamp.filename) + 1, OmniClient.client_id), plistlib.writePlistToString(values))
+        OmniMetadata.expire(self.path)
 
     def parse_file(self, filename):
         """ Parse the plist body of a .client file. """
@@ -457,13 +1046,23 @@ class OmniDelegateManager(object):
         'declined': 'Declined',
         'completed': 'Complete',
     }
-    contexts = {}
 
     def __init__(self, sharer):
         self.sharer = sharer
-        self.db = OmniDb(sharer.username, sharer.client)
+        self.contexts = {}
+        if OmniDelegateManager.ready(sharer.sql):
+            # only looking contexts up, so share the sharer's database
+            self.db = sharer.db
+        else:
+            # creating contexts commits, which would reset `sharer.db.delta`
+            self.db = OmniDb(sharer.username, sharer.client)
         self._load()
 
+    @staticmethod
+    def ready(sql):
+        """ True if every delegation context has been recorded in `sql`. """
+        return all(getattr(sql.delegate_contexts, key) for key in ['root'] + OmniDelegateManager._contexts.keys())
+
     def _load(self):
         """ Load the required delegation contexts, creating them
             if they do not exist.
@@ -485,12 +1084,40 @@ class OmniDelegateManager(object):
         self.db.insert(ctx)
         self.db.commit()
 
+    def user_context(self, type, username):
+        """ The "@username" context within the `type` delegation context,
+            inserted into `self.db` if it doesn't exist yet.
+        """
+        parent = self.contexts[type].id
+        name = '@%s' % username
+        for ctx in self.db._xpath("/of:omnifocus/of:context[of:context/@idref='%s']" % parent):
+            if ctx.name.text == name:
+                return ctx
+        ctx = self.db.create_context(name, idref=parent)
+        self.db.insert(ctx)
+        return ctx
+
+    def delegatee(self, task):
+        """ The username `task` is delegated to, if it is in an "@username"
+            context within the pending ("Delegate") context, else `None`.
+        """
+        try:
+            ctx = self.db.get('context', task.context.get('idref'))
+        except (AttributeError, OmniDb.ElementNotFound):
+            return None
+        parent = getattr(ctx, 'context', None)
+        if parent is None or parent.get('idref') != self.contexts['pending'].id:
+            return None
+        if not ctx.name.text.startswith('@'):
+            return None
+        return ctx.name.text[1:]
+
     def _create_context(self, type, commit=True):
         """ Internal function used for creating root delegate contexts. """
         ctx = self.db.create_context(OmniDelegateManager._contexts[type], idref=self.contexts['root'].id)
         setattr(self.sharer.sql.delegate_contexts, type, ctx.get('id'))
         self.db.insert(ctx)
-        self.sharer.db._insert(ctx)
+        self.sharer.db._insert(copy(ctx))
         if commit:
             self.db.commit()
         return OmniDelegateContext(ctx, self)
@@ -612,33 +1239,108 @@ class OmniSharer(object):
     """ High level class for interacting with OmniFocus databases
         and handling delegated tasks.
     """
-    db = None
+    # mirror the merged tree into `GTDTProjection` tables when loading
+    project = False
     delta = None
-    delegate = None
+    # {username: lock} serialising access to each database within the process
+    _locks = {}
+    _locks_lock = threading.Lock()
 
     def __init__(self, username):
         self.username = username
-        self.sql = GTDTDb(username)
         self.client = OmniClient(self)
-        self.db = OmniDb(username, self.client)
-        self.delegate = OmniDelegateManager(self)
+        self._sql = None
+        self._db = None
+        self._delegate = None
+        # (username, task) delegated during `parse`, awaiting delivery
+        self._outbox = []
+
+    @classmethod
+    def lock(cls, username):
+        """ The lock to hold whilst reading or writing `username`'s database. """
+        with cls._locks_lock:
+            return cls._locks.setdefault(username, threading.RLock())
+
+    @property
+    def sql(self):
+        """ The user's `GTDTDb`, opened on first use. """
+        if self._sql is None:
+            from gtdt import GTDTDb
+            self._sql = GTDTDb(self.username)
+        return self._sql
+
+    @property
+    def db(self):
+        """ The user's `OmniDb`, loaded on first use. """
+        if self._db is None:
+            projection = None
+            if OmniSharer.project:
+                from gtdt import GTDTProjection
+                projection = GTDTProjection(self.username)
+            self._db = OmniDb(self.username, self.client, projection)
+            self._db.subscribe(self._delegate_task, ('added', 'updated', 'moved'), ('task',))
+        return self._db
+
+    @property
+    def delegate(self):
+        """ The user's `OmniDelegateManager`, loaded on first use. """
+        if self._delegate is None:
+            self._delegate = OmniDelegateManager(self)
+        return self._delegate
+
+    @property
+    def idle(self):
+        """ True if the chain hasn't moved since we last synced and the
+            delegation contexts exist, so there is nothing to parse.
+        """
+        return self.client.current and OmniDelegateManager.ready(self.sql)
 
     def parse(self):
         """ Parse new changes to the database and take
             appropriate action for any delegated changes.
+            Returns `False` if there was nothing to parse.
         """
-        print etree.tostring(self.db.delta, pretty_print=True)
-        try:
-            for task in self.db.delta.task:
-                context = OmniDelegateContext(task.context, self.delegate)
-                if not context.isroot() and context.root == self.delegate.pending:
-                    target = OmniSharer(context.username)
-                    el = copy(task)
-                    el.context.set('idref', target.delegate.incoming[self.username].get('id'))
-                    target.db.append(el).commit()
-        except AttributeError:
-            pass
-        #self._track_tasks()
+        with OmniSharer.lock(self.username):
+            if self.idle:
+                return False
+            # load `db` before the delegation contexts are (possibly)
+            # created, so that their commit doesn't reset `db.delta`
+            db = self.db
+            self.delegate
+            db.dispatch()
+            #self._track_tasks()
+        # only one user's lock is ever held, so concurrent syncs can't deadlock
+        self._deliver()
+        # not until the delegated tasks are delivered, so that should
+        # delivery fail the changes are parsed (and delivered) again
+        with OmniSharer.lock(self.username):
+            db.acknowledge()
+        return True
+
+    def _delegate_task(self, event):
+        """ Queue a task in a "Delegate" context for its delegatee. """
+        username = self.delegate.delegatee(event.el)
+        if username is not None:
+            self._outbox.append((username, copy(event.el)))
+
+    def _deliver(self):
+        """ Pass queued tasks on to their delegatees' databases, loading
+            each one once and committing its tasks together; tasks stay
+            queued until they are committed.
+        """
+        outbox = {}
+        for username, el in self._outbox:
+            outbox.setdefault(username, []).append(el)
+        for username, tasks in outbox.iteritems():
+            with OmniSharer.lock(username):
+                delegate = OmniSharer(username).delegate
+                # `delegate.db` has been reloaded if the delegation contexts were created
+                with delegate.db.transaction():
+                    idref = delegate.user_context('incoming', self.username).get('id')
+                    for el in tasks:
+                        el.context.set('idref', idref)
+                        delegate.db.insert(el)
+            self._outbox = [(name, el) for name, el in self._outbox if name != username]
 
     def _track_tasks(self):
         """ Track changes to known delegated tasks. """
@@ -691,5 +1393,130 @@ class OmniSharer(object):
             return None
 
 
+def _users(args):
+    """ The usernames given on the command line, or everyone under `dbs/`. """
+    if args.all:
+        return sorted(username for username in os.listdir('dbs') if os.path.isdir('dbs/%s/OmniFocus.ofocus' % username))
+    return args.users
+
+
+def _sync(username, args):
+    if OmniSharer(username).parse():
+        return 'synced'
+    return 'idle'
+
+
+def _compact(username, args):
+    with OmniSharer.lock(username):
+        return 'removed %d files' % OmniSharer(username).db.compact()
+
+
+def _stats(username, args):
+    client = OmniSharer(username).client
+    metadata = client.metadata
+    size = sum(os.path.getsize('%s/%s' % (metadata.path, fn)) for fn, tail_id in metadata.chain)
+    return 'files=%d bytes=%d clients=%d pending=%s current=%s oldest=%s' % (
+        len(metadata.chain), size, len(metadata.clients), metadata.pending(client.tail_id),
+        client.current, metadata.oldest_tail_id)
+
+
+def _bench(username, args):
+    def timed(func):
+        start = time.time()
+        for i in xrange(args.iterations):
+            func()
+        return (time.time() - start) / args.iterations * 1000
+    client = OmniSharer(username).client
+    configured = OmniDb.cache
+    # time the cache even if it isn't enabled, in a scratch directory
+    scratch = tempfile.mkdtemp() if configured is None else None
+    try:
+        OmniDb.cache = None
+        # warm up first, so the deferred imports aren't timed
+        OmniDb(username, client)
+        results = [('load', timed(lambda: OmniDb(username, client)))]
+        OmniDb.cache = configured or OmniDeltaCache(scratch)
+        OmniDb(username, client)
+        results.append(('cached', timed(lambda: OmniDb(username, client))))
+    finally:
+        OmniDb.cache = configured
+        if scratch is not None:
+            shutil.rmtree(scratch, True)
+    results.append(('idle', timed(lambda: OmniSharer(username).idle)))
+    if args.webdav_standin:
+        from webdav import OmniWebDAVServer, OmniWebDAVStorage
+        server = OmniWebDAVServer('dbs').start()
+        url = '%s%s/OmniFocus.ofocus' % (server.url, username)
+        mirror = tempfile.mkdtemp()
+        def fetch():
+            shutil.rmtree(mirror, True)
+            OmniWebDAVStorage(url, mirror).refresh()
+        try:
+            results.append(('mirror', timed(fetch)))
+            results.append(('refresh', timed(OmniWebDAVStorage(url, mirror).refresh)))
+        finally:
+            server.stop()
+            shutil.rmtree(mirror, True)
+    return ' '.join('%s=%.2fms' % result for result in results)
+
+
+def main(argv=None):
+    """ Command line entry point, handling any number of users in one
+        process (sharing its caches), optionally in parallel.
+            `main.py sync --all --jobs 4`
+            `main.py stats wrboyce`
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Share delegated tasks between OmniFocus databases.')
+    parser.add_argument('--webdav', metavar='URL', help='URL template of the WebDAV server, e.g. http://host/%%(username)s/OmniFocus.ofocus')
+    parser.add_argument('--project', action='store_true', help='mirror loaded databases into the SQLite projection')
+    parser.add_argument('--cache', action='store_true', help='keep inflated delta files under cache/ (beside db.sqlite) to speed up loading')
+    commands = parser.add_subparsers(dest='command')
+    for name, help in (('sync', 'parse new changes and pass on delegated tasks'),
+                       ('compact', 'fold delta files no client still needs into a new base file'),
+                       ('stats', 'summarise the delta chain without loading it'),
+                       ('bench', 'time loading each database')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('users', nargs='*', metavar='user')
+        command.add_argument('--all', action='store_true', help='every user under dbs/')
+        command.add_argument('-j', '--jobs', type=int, default=1, help='users to process in parallel')
+        if name == 'bench':
+            command.add_argument('-n', '--iterations', type=int, default=10)
+            command.add_argument('--webdav-standin', action='store_true', help='also time mirroring via a local WebDAV server')
+    args = parser.parse_args(argv)
+    users = _users(args)
+    if not users:
+        parser.error('no users given (and --all not specified)')
+    if args.webdav:
+        from storage import OmniStorage
+        OmniStorage.url = args.webdav
+    OmniSharer.project = args.project
+    if args.cache:
+        OmniDb.cache = OmniDeltaCache()
+    func = {'sync': _sync, 'compact': _compact, 'stats': _stats, 'bench': _bench}[args.command]
+    def run(username):
+        try:
+            return username, func(username, args), None
+        except Exception as e:
+            return username, None, e
+    if args.jobs > 1 and len(users) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(args.jobs, len(users)))
+        results = pool.imap(run, users)
+    else:
+        pool = None
+        results = (run(username) for username in users)
+    failed = False
+    for username, result, error in results:
+        if error is None:
+            print '%s: %s' % (username, result)
+        else:
+            failed = True
+            print >>sys.stderr, '%s: %s: %s' % (username, error.__class__.__name__, error)
+    if pool is not None:
+        pool.close()
+    return 1 if failed else 0
+
+
 if __name__ == '__main__':
-    OmniSharer('wrboyce').parse()
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+    Storage backends for `.ofocus` databases.
+
+    Every backend keeps the database's files in a local directory at
+    `storage.path` (for WebDAV this is a mirror, brought up to date by
+    `refresh`), so parsing and metadata can always work from local files;
+    writes and deletes go through the backend.
+"""
+import os
+import tempfile
+import threading
+
+
+class OmniStorage(object):
+    """ Interface to the files of an `.ofocus` database. """
+    # URL template (`%(username)s`) of a WebDAV server holding everyone's
+    # databases, or `None` to use the local `dbs` directory directly
+    url = None
+    # {(url, username): storage} shared within the process, see `for_user`
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        # True until the next `refresh`, see `update`
+        self.stale = True
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_user(cls, username):
+        """ The configured storage for `username`'s database, shared
+            within the process so it is only refreshed once per `expire`.
+        """
+        with cls._shared_lock:
+            storage = cls._shared.get((cls.url, username))
+            if storage is None:
+                path = 'dbs/%s/OmniFocus.ofocus' % username
+                if cls.url:
+                    # only import the HTTP machinery when it's used
+                    from webdav import OmniWebDAVStorage
+                    storage = OmniWebDAVStorage(cls.url % {'username': username}, path)
+                else:
+                    storage = OmniLocalStorage(path)
+                cls._shared[cls.url, username] = storage
+            return storage
+
+    @classmethod
+    def expire(cls):
+        """ Mark every shared storage stale, so each is refreshed again on
+            its next `update`; call before each round of syncs in a
+            long-running process.
+        """
+        with cls._shared_lock:
+            for storage in cls._shared.itervalues():
+                storage.stale = True
+
+    def refresh(self):
+        """ Bring `path` up to date with the backend. """
+        self.stale = False
+        return self
+
+    def update(self):
+        """ `refresh` unless that's been done since we were marked stale. """
+        with self._lock:
+            if self.stale:
+                self.refresh()
+        return self
+
+    def list(self):
+        """ Returns {name: (size, mtime)} for every file. """
+        raise NotImplementedError
+
+    def read(self, name):
+        """ Returns the contents of file `name`. """
+        raise NotImplementedError
+
+    def write(self, name, data):
+        """ Atomically create (or replace) file `name`. """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """ Remove file `name`. """
+        raise NotImplementedError
+
+    class Error(Exception):
+        pass
+
+
+class OmniLocalStorage(OmniStorage):
+    """ A database in a local directory. """
+    def list(self):
+        files = {}
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat('%s/%s' % (self.path, name))
+            except OSError:
+                continue
+            files[name] = (st.st_size, st.st_mtime)
+        return files
+
+    def read(self, name):
+        f = open('%s/%s' % (self.path, name), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write(self, name, data, mtime=None):
+        """ Atomically create (or replace) file `name`,
+            optionally setting its mtime.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, '%s/%s' % (self.path, name))
+
+    def delete(self, name):
+        try:
+            os.remove('%s/%s' % (self.path, name))
+        except OSError:
+            pass
@@ -0,0 +1,585 @@
+from copy import copy
+from cStringIO import StringIO
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import unittest
+
+from lxml import etree
+
+from gtdt import GTDTPool, GTDTProjection
+from main import OmniClient, OmniDate, OmniDb, OmniDeltaCache, OmniMetadata, OmniSharer, main
+from storage import OmniStorage
+
+
+class OmniTestCase(unittest.TestCase):
+    """ Runs each test in a temporary directory holding a copy of the
+        sample database for each of `users` and its own db.sqlite.
+    """
+    users = ('wrboyce',)
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(self.cleanup)
+        for username in self.users:
+            shutil.copytree(os.path.join(self.cwd, 'dbs/wrboyce'), os.path.join(self.dir, 'dbs', username))
+        os.chdir(self.dir)
+        GTDTPool._shared = GTDTPool(os.path.join(self.dir, 'db.sqlite'))
+        GTDTPool._shared.execute('CREATE TABLE delegate_contexts (username TEXT NOT NULL, root TEXT, incoming TEXT, '
+                                 'pending TEXT, accepted TEXT, declined TEXT, completed TEXT)')
+        GTDTPool._shared.execute('CREATE TABLE tracked_tasks (username TEXT NOT NULL, delegator TEXT, task_id TEXT)')
+        self.db = self.open()
+        self.files = sorted(os.listdir(self.db.path))
+
+    def cleanup(self):
+        GTDTPool._shared = None
+        OmniStorage._shared.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def open(self, username=None):
+        username = username or self.users[0]
+        return OmniDb(username, OmniClient(OmniSharer(username)))
+
+    def foreign(self, db, *els):
+        """ Commit `els` to `db` as another client would, leaving them unseen. """
+        tail_id = db._tail_id
+        for el in els:
+            db.insert(el)
+        db.commit()
+        db._client.generate_file(OmniDate.now(), tail_id)
+
+    def unseen(self, name):
+        """ Commit a new context as another client would. """
+        db = self.open()
+        db.insert(db.create_context('Seen')).commit()
+        ctx = db.create_context(name)
+        self.foreign(db, ctx)
+        return ctx
+
+
+class OmniMetadataTest(unittest.TestCase):
+    """ Uses empty files in a temporary directory; only names are parsed. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.addCleanup(OmniMetadata._cache.clear)
+        self.path = os.path.join(self.dir, 'OmniFocus.ofocus')
+        os.mkdir(self.path)
+        self.touch('00000000000000=h+t0.zip')
+        self.touch('20100101000000=t0+t1.zip')
+        self.touch('20100102000000=t1+t2.zip')
+        # not linked to the chain
+        self.touch('20100103000000=xx+yy.zip')
+
+    def touch(self, fn):
+        open(os.path.join(self.path, fn), 'wb').close()
+
+    def client(self, fn, *tail_ids, **kwargs):
+        fn = os.path.join(self.path, fn)
+        plistlib.writePlist({'tailIdentifiers': list(tail_ids)}, fn)
+        if 'mtime' in kwargs:
+            os.utime(fn, (kwargs['mtime'], kwargs['mtime']))
+
+    def set_mtime(self, mtime):
+        os.utime(self.path, (mtime, mtime))
+
+    def test_chain(self):
+        metadata = OmniMetadata.get(self.path)
+        self.assertEqual(metadata.head_id, 'h')
+        self.assertEqual([tail_id for fn, tail_id in metadata.chain], ['t0', 't1', 't2'])
+        self.assertEqual(metadata.tip_id, 't2')
+        self.assertEqual(metadata.pending('t0'), 2)
+        self.assertEqual(metadata.pending('t2'), 0)
+        self.assertEqual(metadata.pending('yy'), None)
+        self.assertEqual(metadata.pending(None), None)
+
+    def test_refresh(self):
+        self.set_mtime(1000000000)
+        metadata = OmniMetadata.get(self.path)
+        self.touch('20100104000000=t2+t3.zip')
+        # the directory is only rescanned when its mtime changes
+        self.set_mtime(1000000000)
+        self.assertEqual(OmniMetadata.get(self.path).tip_id, 't2')
+        self.set_mtime(1000000001)
+        self.assertIs(OmniMetadata.get(self.path), metadata)
+        self.assertEqual(metadata.tip_id, 't3')
+        self.assertEqual(metadata.pending('t0'), 3)
+        # or it is expired
+        self.touch('20100105000000=t3+t4.zip')
+        self.set_mtime(1000000001)
+        OmniMetadata.expire(self.path)
+        self.assertEqual(OmniMetadata.get(self.path).tip_id, 't4')
+
+    def test_client_rewritten(self):
+        self.client('20100101000000=A.client', 't0', mtime=1000000000)
+        self.set_mtime(1000000000)
+        self.assertEqual(OmniMetadata.get(self.path).clients, {'A': ['t0']})
+        # rewritten in place, the directory listing is unchanged
+        self.client('20100101000000=A.client', 't1', mtime=1000000001)
+        self.set_mtime(1000000000)
+        self.assertEqual(OmniMetadata.get(self.path).clients, {'A': ['t1']})
+
+    def test_oldest_tail_id(self):
+        self.assertEqual(OmniMetadata.get(self.path).oldest_tail_id, None)
+        self.client('20100101000000=A.client', 't0')
+        self.client('20100102000000=A.client', 't2')
+        self.client('20100101000000=B.client', 't1')
+        self.client('20100101000000=C.client', 'yy')
+        OmniMetadata.expire(self.path)
+        metadata = OmniMetadata.get(self.path)
+        # A's latest file wins, C's tail isn't in the chain
+        self.assertEqual(metadata.clients, {'A': ['t2'], 'B': ['t1'], 'C': ['yy']})
+        self.assertEqual(metadata.oldest_tail_id, 't1')
+        os.remove(os.path.join(self.path, '20100101000000=B.client'))
+        OmniMetadata.expire(self.path)
+        self.assertEqual(OmniMetadata.get(self.path).oldest_tail_id, 't2')
+
+    def test_relative_path(self):
+        other = os.path.join(self.dir, 'other')
+        shutil.copytree(self.path, os.path.join(other, 'OmniFocus.ofocus'))
+        open(os.path.join(other, 'OmniFocus.ofocus', '20100104000000=t2+t3.zip'), 'wb').close()
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.dir)
+            self.assertEqual(OmniMetadata.get('OmniFocus.ofocus').tip_id, 't2')
+            os.chdir(other)
+            self.assertEqual(OmniMetadata.get('OmniFocus.ofocus').tip_id, 't3')
+        finally:
+            os.chdir(cwd)
+
+
+class OmniDbTest(OmniTestCase):
+    def contexts(self, db):
+        return [ctx.name for ctx in db._xpath('/of:omnifocus/of:context')]
+
+    def test_rollback(self):
+        before = etree.tostring(self.db.root)
+        task = self.db._xpath('/of:omnifocus/of:task')[0]
+        with self.assertRaises(KeyError):
+            with self.db.transaction():
+                ctx = self.db.create_context('Rolled back')
+                self.db.insert(ctx)
+                with self.db.update(ctx):
+                    ctx.name = 'Renamed'
+                self.db.remove(task)
+                raise KeyError
+        self.assertEqual(etree.tostring(self.db.root), before)
+        self.assertEqual(self.db._changes, [])
+        self.assertEqual(sorted(os.listdir(self.db.path)), self.files)
+
+    def test_savepoint(self):
+        with self.db.transaction():
+            self.db.insert(self.db.create_context('Kept'))
+            try:
+                with self.db.transaction():
+                    self.db.insert(self.db.create_context('Rolled back'))
+                    raise KeyError
+            except KeyError:
+                pass
+            self.assertEqual(len(self.db._changes), 1)
+        self.assertEqual(len(os.listdir(self.db.path)), len(self.files) + 2)
+        contexts = self.contexts(self.open())
+        self.assertIn('Kept', contexts)
+        self.assertNotIn('Rolled back', contexts)
+
+    def test_update(self):
+        task = self.db._xpath('/of:omnifocus/of:task')[0]
+        id, name = task.get('id'), task.name.text
+        with self.assertRaises(KeyError):
+            with self.db.transaction():
+                with self.db.update(task):
+                    task.name = 'Renamed'
+                raise KeyError
+        self.assertEqual(self.db.get('task', id).name, name)
+        with self.db.transaction():
+            with self.db.update(self.db.get('task', id)) as task:
+                task.name = 'Renamed'
+        self.assertEqual(self.open().get('task', id).name, 'Renamed')
+
+    def test_update_savepoint(self):
+        task = self.db._xpath('/of:omnifocus/of:task')[0]
+        id, name = task.get('id'), task.name.text
+        with self.db.transaction():
+            with self.db.update(task):
+                task.name = 'Outer'
+            try:
+                with self.db.transaction():
+                    with self.db.update(self.db.get('task', id)) as task:
+                        task.name = 'Inner'
+                    raise KeyError
+            except KeyError:
+                pass
+            self.assertEqual(self.db.get('task', id).name, 'Outer')
+            self.db.rollback()
+        self.assertEqual(self.db.get('task', id).name, name)
+        self.assertEqual(sorted(os.listdir(self.db.path)), self.files)
+
+    def test_insert_in_place(self):
+        task = self.db._xpath('/of:omnifocus/of:task')[0]
+        task.name = 'Renamed'
+        self.assertRaises(OmniDb.InPlaceChange, self.db.insert, task)
+
+    def test_projection(self):
+        ctx = self.db.create_context('Projected')
+        self.db.insert(ctx).commit()
+        pool = GTDTPool('db.sqlite')
+        other = GTDTPool('db.sqlite', timeout=0.1, retries=1)
+        other.execute('CREATE TABLE writes (value INTEGER)')
+        merge = OmniDb._merge_delta
+        def merging(db, *args, **kwargs):
+            # other connections can still write whilst we're merging
+            other.execute('INSERT INTO writes (value) VALUES (1)')
+            return merge(db, *args, **kwargs)
+        OmniDb._merge_delta = merging
+        try:
+            db = OmniDb('wrboyce', OmniClient(OmniSharer('wrboyce')), GTDTProjection('wrboyce', pool))
+        finally:
+            OmniDb._merge_delta = merge
+        projection = db._projection
+        self.assertEqual(projection.tail_id, db._tail_id)
+        self.assertEqual(projection.get('of_contexts', ctx.get('id'))['name'], 'Projected')
+        self.assertEqual(len(projection.filter('of_contexts')), len(self.db._xpath('/of:omnifocus/of:context')))
+
+    def test_acknowledge(self):
+        ctx = self.unseen('Unseen')
+        db = self.open()
+        self.assertFalse(db._client.current)
+        self.assertEqual([event.id for event in db.events()], [ctx.get('id')])
+        db.acknowledge()
+        db = self.open()
+        self.assertTrue(db._client.current)
+        self.assertEqual(list(db.events()), [])
+
+    def test_commit_unseen(self):
+        ctx = self.unseen('Unseen')
+        # e.g. a delegated task delivered to a database not parsed yet
+        db = self.open()
+        delivered = db.create_context('Delivered')
+        with db.transaction():
+            db.insert(delivered)
+        db = self.open()
+        self.assertFalse(db._client.current)
+        self.assertEqual([event.id for event in db.events()], [ctx.get('id'), delivered.get('id')])
+
+    def test_remove(self):
+        ctx = self.db.create_context('Removed')
+        self.db.insert(ctx).commit()
+        self.db.remove(self.db.get('context', ctx.get('id'))).commit()
+        self.assertRaises(OmniDb.ElementNotFound, self.open().get, 'context', ctx.get('id'))
+
+
+class OmniDeltaCacheTest(OmniTestCase):
+    def setUp(self):
+        super(OmniDeltaCacheTest, self).setUp()
+        for name in ('A', 'B'):
+            self.db.insert(self.db.create_context(name)).commit()
+        self.deltas = ['%s/%s' % (self.db.path, fn) for fn in sorted(os.listdir(self.db.path)) if fn.endswith('.zip')]
+        self.cache = OmniDeltaCache('cache')
+
+    def entries(self):
+        return sorted(os.listdir('cache'))
+
+    def xml(self, tree):
+        return etree.tostring(tree)
+
+    def contexts(self, db):
+        return [ctx.name for ctx in db._xpath('/of:omnifocus/of:context')]
+
+    def test_miss(self):
+        fn = self.deltas[1]
+        self.assertFalse(os.path.exists('cache'))
+        self.assertEqual(self.xml(self.cache.parse(fn)), self.xml(OmniDeltaCache.read(fn)))
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_hit(self):
+        fn = self.deltas[1]
+        expected = self.xml(self.cache.parse(fn))
+        entry = self.cache._entry(fn)
+        os.utime(entry, (1000000000, 1000000000))
+
+        def read(fn):
+            self.fail('read %s on a hit' % fn)
+        self.cache.read = read
+        self.assertEqual(self.xml(self.cache.parse(fn)), expected)
+        # touched, so it is the most recently used
+        self.assertNotEqual(os.stat(entry).st_mtime, 1000000000)
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_load(self):
+        expected = [self.contexts(self.open())]
+        OmniDb.cache = self.cache
+        try:
+            for i in range(2):
+                self.assertEqual(self.contexts(self.open()), expected[0])
+        finally:
+            OmniDb.cache = None
+        self.assertEqual(len(self.entries()), len(self.deltas))
+
+    def test_mtime_changed(self):
+        fn = self.deltas[1]
+        self.cache.parse(fn)
+        entry = self.cache._entry(fn)
+        st = os.stat(fn)
+        os.utime(fn, (st.st_atime, st.st_mtime + 10))
+        self.assertNotEqual(self.cache._entry(fn), entry)
+        self.cache.parse(fn)
+        self.assertEqual(self.entries(), sorted([os.path.basename(entry), os.path.basename(self.cache._entry(fn))]))
+
+    def test_size_changed(self):
+        fn, other = self.deltas[1], self.deltas[0]
+        self.assertNotEqual(os.path.getsize(fn), os.path.getsize(other))
+        self.cache.parse(fn)
+        entry = self.cache._entry(fn)
+        # replaced, keeping the mtime
+        st = os.stat(fn)
+        shutil.copyfile(other, fn)
+        os.utime(fn, (st.st_atime, st.st_mtime))
+        self.assertNotEqual(self.cache._entry(fn), entry)
+        self.assertEqual(self.xml(self.cache.parse(fn)), self.xml(OmniDeltaCache.read(other)))
+
+    def test_evict(self):
+        for i, fn in enumerate(self.deltas):
+            self.cache.parse(fn)
+            os.utime(self.cache._entry(fn), (1000000000 + i, 1000000000 + i))
+        entries = [os.path.basename(self.cache._entry(fn)) for fn in self.deltas]
+        sizes = dict((entry, os.path.getsize('cache/%s' % entry)) for entry in entries)
+        # a hit makes the oldest entry the most recently used
+        self.cache.parse(self.deltas[0])
+        self.cache.limit = sum(sizes.values()) - 1
+        self.cache._evict()
+        self.assertEqual(self.entries(), sorted(entries[:1] + entries[2:]))
+        self.cache.limit = sizes[entries[0]]
+        self.cache._evict()
+        self.assertEqual(self.entries(), entries[:1])
+
+
+class OmniEventTest(OmniTestCase):
+    def setUp(self):
+        super(OmniEventTest, self).setUp()
+        self.parent = self.db.create_context('Parent')
+        self.child = self.db.create_context('Child')
+        self.db.insert(self.parent).insert(self.child).commit()
+        self.task = self.db._xpath('/of:omnifocus/of:task')[0]
+
+    def change(self, func):
+        """ Make changes with `func(db)` as another client would,
+            returning the events they cause.
+        """
+        db = self.open()
+        tail_id = db._tail_id
+        with db.transaction():
+            func(db)
+        db._client.generate_file(OmniDate.now(), tail_id)
+        return list(self.open().events())
+
+    def rename_task(self, db):
+        with db.update(db.get('task', self.task.get('id'))) as task:
+            task.name = 'Renamed'
+
+    def move_child(self, db):
+        with db.update(db.get('context', self.child.get('id'))) as ctx:
+            ctx.context = None
+            ctx.context.set('idref', self.parent.get('id'))
+
+    def test_updated(self):
+        event, = self.change(self.rename_task)
+        self.assertEqual((event.kind, event.node_type, event.id), ('updated', 'task', self.task.get('id')))
+        self.assertEqual(event.fields, ['name'])
+
+    def test_moved(self):
+        event, = self.change(self.move_child)
+        self.assertEqual((event.kind, event.node_type, event.id), ('moved', 'context', self.child.get('id')))
+        self.assertEqual(event.fields, ['context'])
+
+    def test_added_deleted(self):
+        ctx = self.db.create_context('Added')
+
+        def change(db):
+            db.insert(ctx)
+            db.remove(db.get('context', self.child.get('id')))
+        added, deleted = self.change(change)
+        self.assertEqual((added.kind, added.id), ('added', ctx.get('id')))
+        self.assertEqual(added.fields, ['added', 'name', 'rank'])
+        self.assertEqual((deleted.kind, deleted.id), ('deleted', self.child.get('id')))
+
+    def test_subscribe(self):
+        def change(db):
+            self.rename_task(db)
+            self.move_child(db)
+            db.insert(db.create_context('Added'))
+        self.change(change)
+        db = self.open()
+        received = dict((name, []) for name in ('all', 'moved', 'task', 'added_task'))
+        db.subscribe(received['all'].append)
+        db.subscribe(received['moved'].append, ('moved',))
+        db.subscribe(received['task'].append, node_types=('task',))
+        db.subscribe(received['added_task'].append, ('added',), ('task',))
+        db.dispatch()
+        kinds = lambda events: [(event.kind, event.node_type) for event in events]
+        self.assertEqual(kinds(received['all']), [('moved', 'context'), ('added', 'context'), ('updated', 'task')])
+        self.assertEqual(kinds(received['moved']), [('moved', 'context')])
+        self.assertEqual(kinds(received['task']), [('updated', 'task')])
+        self.assertEqual(received['added_task'], [])
+
+
+class OmniSharerTest(OmniTestCase):
+    def test_first_sync(self):
+        self.assertTrue(OmniSharer('wrboyce').parse())
+        sharer = OmniSharer('wrboyce')
+        self.assertTrue(sharer.idle)
+        self.assertFalse(sharer.parse())
+
+    def test_acknowledge_behind(self):
+        self.db.insert(self.db.create_context('Seen')).commit()
+        db = self.open()
+        # e.g. the delegation contexts, committed after `db` was loaded
+        other = self.open()
+        other.insert(other.create_context('Later')).commit()
+        db.acknowledge()
+        self.assertEqual(self.open()._client.tail_id, other._tail_id)
+
+    def test_failed_delivery(self):
+        OmniSharer('wrboyce').parse()
+        self.unseen('Unseen')
+        sharer = OmniSharer('wrboyce')
+        def deliver():
+            raise IOError
+        sharer._deliver = deliver
+        self.assertRaises(IOError, sharer.parse)
+        self.assertFalse(OmniSharer('wrboyce').idle)
+
+
+
+class OmniDeliveryTest(OmniTestCase):
+    users = ('alice', 'bob')
+
+    def setUp(self):
+        OmniTestCase.setUp(self)
+        for username in self.users:
+            OmniSharer(username).parse()
+
+    def delegate(self, username):
+        """ Commit a new task in alice's "@username" delegation context. """
+        db = OmniSharer('alice').delegate.db
+        ctx = db.create_context('@%s' % username, idref=db._client.sharer.sql.delegate_contexts.pending)
+        task = copy(db.get('task', 'jzggk_-5Joq'))
+        task.set('id', db._generate_id())
+        task.context = None
+        task.context.set('idref', ctx.get('id'))
+        self.foreign(db, ctx, task)
+        return task
+
+    def test_deliver(self):
+        task = self.delegate('bob')
+        # bob's own change, not yet parsed, mustn't be hidden by the delivery
+        db = self.open('bob')
+        unseen = db.create_context('Unseen')
+        self.foreign(db, unseen)
+        alice = OmniSharer('alice')
+        self.assertTrue(alice.parse())
+        self.assertEqual(alice._outbox, [])
+        self.assertTrue(OmniSharer('alice').idle)
+        bob = OmniSharer('bob')
+        self.assertFalse(bob.idle)
+        delivered = bob.db.get('task', task.get('id'))
+        ctx = bob.db.get('context', delivered.context.get('idref'))
+        self.assertEqual(ctx.name, '@alice')
+        self.assertEqual(ctx.context.get('idref'), bob.sql.delegate_contexts.incoming)
+        self.assertEqual([event.id for event in bob.db.events()], [unseen.get('id'), ctx.get('id'), task.get('id')])
+
+    def test_deliver_failure(self):
+        task = self.delegate('carol')
+        alice = OmniSharer('alice')
+        self.assertRaises(OSError, alice.parse)
+        self.assertEqual([username for username, el in alice._outbox], ['carol'])
+        self.assertFalse(OmniSharer('alice').idle)
+
+
+
+class OmniCompactTest(OmniTestCase):
+    def setUp(self):
+        OmniTestCase.setUp(self)
+        for name in ('A', 'B', 'C'):
+            self.db.insert(self.db.create_context(name)).commit()
+        self.metadata = self.db._client.metadata
+        self.tail_ids = [tail_id for fn, tail_id in self.metadata.chain]
+
+    def other_client(self, tail_id):
+        plistlib.writePlist({'tailIdentifiers': [tail_id]}, '%s/20000101000000=Other.client' % self.db.path)
+
+    def children(self, db):
+        return sorted(etree.tostring(el) for el in db.root.iterchildren())
+
+    def test_compact(self):
+        before = self.children(self.db)
+        self.other_client(self.tail_ids[2])
+        self.assertEqual(self.db.compact(), 3)
+        metadata = self.db._client.metadata
+        self.assertEqual([tail_id for fn, tail_id in metadata.chain], self.tail_ids[2:])
+        base = metadata.chain[0][0]
+        self.assertTrue(base.startswith('00000000000000='))
+        self.assertTrue(base.endswith('+%s.zip' % self.tail_ids[2]))
+        self.assertEqual(sorted(os.listdir(self.db.path)),
+                         sorted([fn for fn, tail_id in metadata.chain] + [fn for fn in os.listdir(self.db.path) if fn.endswith('.client')]))
+        self.assertEqual(metadata.head_id, base[15:].split('+')[0])
+        self.assertEqual(self.db._client.tail_id, self.tail_ids[-1])
+        self.assertEqual(metadata.oldest_tail_id, self.tail_ids[2])
+        db = self.open()
+        self.assertEqual(self.children(db), before)
+        self.assertEqual(list(db.events()), [])
+
+    def test_compact_nothing(self):
+        self.other_client(self.tail_ids[0])
+        self.assertEqual(self.db.compact(), 0)
+        self.assertEqual([tail_id for fn, tail_id in self.db._client.metadata.chain], self.tail_ids)
+
+    def test_compact_unknown_client(self):
+        # tail ids no longer in the chain don't hold compaction back
+        self.other_client('unknown')
+        self.assertEqual(self.db.compact(), 4)
+        self.assertEqual([tail_id for fn, tail_id in self.db._client.metadata.chain], self.tail_ids[-1:])
+        self.assertTrue(self.open()._client.current)
+
+
+class CommandTest(OmniTestCase):
+    users = ('alice', 'bob')
+
+    def run_main(self, *argv):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            status = main(list(argv))
+            return status, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_all(self):
+        os.makedirs('dbs/empty')
+        status, out, err = self.run_main('stats', '--all')
+        self.assertEqual(status, 0)
+        self.assertEqual([line.split(':')[0] for line in out.splitlines()], ['alice', 'bob'])
+
+    def test_sync(self):
+        status, out, err = self.run_main('sync', 'alice', 'bob', '--jobs', '2')
+        self.assertEqual((status, out), (0, 'alice: synced\nbob: synced\n'))
+        status, out, err = self.run_main('sync', '--all')
+        self.assertEqual((status, out), (0, 'alice: idle\nbob: idle\n'))
+
+    def test_compact(self):
+        status, out, err = self.run_main('compact', 'alice')
+        self.assertEqual((status, out), (0, 'alice: removed 0 files\n'))
+
+    def test_errors(self):
+        status, out, err = self.run_main('stats', 'alice', 'nobody')
+        self.assertEqual(status, 1)
+        self.assertTrue(out.startswith('alice: files=1 '))
+        self.assertTrue(err.startswith('nobody: OSError: '))
+        self.assertRaises(SystemExit, self.run_main, 'stats')
+
+
+if __name__ == '__main__':
+    unittest.main()
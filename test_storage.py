@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import OmniLocalStorage, OmniStorage
+from webdav import OmniWebDAVServer, OmniWebDAVStorage
+
+
+class OmniLocalStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = OmniLocalStorage(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write(self):
+        self.storage.write('a.zip', 'data')
+        self.assertEqual(self.storage.read('a.zip'), 'data')
+        self.storage.write('a.zip', 'replaced')
+        self.assertEqual(self.storage.read('a.zip'), 'replaced')
+        self.assertEqual(self.storage.list().keys(), ['a.zip'])
+
+    def test_delete(self):
+        self.storage.write('a.zip', 'data')
+        self.storage.delete('a.zip')
+        self.storage.delete('a.zip')
+        self.assertEqual(self.storage.list(), {})
+
+    def test_for_user(self):
+        storage = OmniStorage.for_user('_test')
+        self.assertTrue(OmniStorage.for_user('_test') is storage)
+        self.assertTrue(storage.update().stale is False)
+        OmniStorage.expire()
+        self.assertTrue(storage.stale)
+
+
+class OmniWebDAVStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs('%s/remote/OmniFocus.ofocus' % self.path)
+        self.server = OmniWebDAVServer('%s/remote' % self.path).start()
+        self.url = '%sOmniFocus.ofocus/' % self.server.url
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.path)
+
+    def storage(self, name):
+        return OmniWebDAVStorage(self.url, '%s/%s' % (self.path, name))
+
+    def test_refresh(self):
+        writer = self.storage('writer')
+        for i in range(10):
+            writer.write('%d.zip' % i, 'data %d' % i)
+        reader = self.storage('reader').refresh()
+        self.assertEqual(sorted(reader.list()), sorted(writer.list()))
+        self.assertEqual(reader.read('5.zip'), 'data 5')
+        gets, propfinds = self.server.requests['GET'], self.server.requests['PROPFIND']
+        reader.refresh()
+        self.assertEqual(self.server.requests['GET'], gets)
+        self.assertEqual(self.server.requests['PROPFIND'], propfinds + 1)
+
+    def test_write(self):
+        writer = self.storage('writer')
+        writer.write('a.zip', 'data')
+        self.assertEqual(self.server.requests, {'PUT': 1, 'MOVE': 1})
+        self.assertEqual(writer.read('a.zip'), 'data')
+        self.assertEqual(self.storage('reader').refresh().read('a.zip'), 'data')
+
+    def test_update(self):
+        reader = self.storage('reader')
+        reader.update().update()
+        self.assertEqual(self.server.requests['PROPFIND'], 1)
+        reader.stale = True
+        reader.update()
+        self.assertEqual(self.server.requests['PROPFIND'], 2)
+
+    def test_delete(self):
+        writer = self.storage('writer')
+        writer.write('a.zip', 'data')
+        reader = self.storage('reader').refresh()
+        writer.delete('a.zip')
+        self.assertEqual(reader.refresh().list(), {})
+        self.assertEqual(writer.list(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+"""
+    WebDAV storage backend for `.ofocus` databases, and an in-process
+    stand-in server for tests and benchmarks.
+"""
+import BaseHTTPServer
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import httplib
+import os
+import Queue
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+from storage import OmniLocalStorage, OmniStorage
+
+
+class OmniWebDAVStorage(OmniLocalStorage):
+    """ A database on a WebDAV server, mirrored into a local directory.
+
+        `refresh` issues a single PROPFIND and fetches any new or changed
+        files concurrently (`workers` at a time) over a pool of persistent
+        connections; unchanged files are never downloaded twice.
+    """
+    def __init__(self, url, path, workers=4, timeout=30):
+        OmniLocalStorage.__init__(self, path)
+        if not url.endswith('/'):
+            url = '%s/' % url
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        parts = urlparse.urlsplit(url)
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._base = parts.path
+        self._pool = Queue.LifoQueue()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _connect(self):
+        if self._scheme == 'https':
+            return httplib.HTTPSConnection(self._netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self._netloc, timeout=self.timeout)
+
+    def _request(self, method, name='', body=None, headers=None):
+        """ Make a request over a pooled connection, retrying once on a
+            fresh connection if a kept-alive one has gone away.
+            Returns (status, body, headers).
+        """
+        path = '%s%s' % (self._base, urllib.quote(name))
+        for attempt in (0, 1):
+            try:
+                conn = self._pool.get_nowait()
+            except Queue.Empty:
+                conn = self._connect()
+            try:
+                conn.request(method, path, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                self._pool.put(conn)
+            return response.status, data, dict(response.getheaders())
+
+    def _propfind(self, name='', depth=1):
+        """ Returns {name: (size, mtime)} from a PROPFIND of `name`. """
+        body = ('<?xml version="1.0" encoding="utf-8"?>'
+                '<propfind xmlns="DAV:"><prop><getcontentlength/><getlastmodified/><resourcetype/></prop></propfind>')
+        status, data, headers = self._request('PROPFIND', name, body, {'Depth': str(depth), 'Content-Type': 'application/xml'})
+        if status != 207:
+            raise OmniStorage.Error('PROPFIND %s%s: %s' % (self.url, name, status))
+        files = {}
+        for response in ElementTree.fromstring(data).findall('{DAV:}response'):
+            prop = response.find('{DAV:}propstat/{DAV:}prop')
+            if prop is None or prop.find('{DAV:}resourcetype/{DAV:}collection') is not None:
+                continue
+            href = urllib.unquote(urlparse.urlsplit(response.findtext('{DAV:}href')).path)
+            name = href.rstrip('/').split('/')[-1]
+            if name.startswith('.'):
+                # another client's write in progress
+                continue
+            files[name] = (
+                int(prop.findtext('{DAV:}getcontentlength') or 0),
+                mktime_tz(parsedate_tz(prop.findtext('{DAV:}getlastmodified'))),
+            )
+        return files
+
+    def _fetch(self, name, mtime):
+        """ Download `name` into the mirror. """
+        status, data, headers = self._request('GET', name)
+        if status != 200:
+            raise OmniStorage.Error('GET %s%s: %s' % (self.url, name, status))
+        OmniLocalStorage.write(self, name, data, mtime)
+
+    def refresh(self):
+        remote = self._propfind()
+        local = OmniLocalStorage.list(self)
+        for name in set(local) - set(remote):
+            OmniLocalStorage.delete(self, name)
+        queue = Queue.Queue()
+        for name, (size, mtime) in remote.iteritems():
+            if name not in local or local[name][0] != size or int(local[name][1]) != mtime:
+                queue.put((name, mtime))
+        errors = []
+        def worker():
+            while True:
+                try:
+                    name, mtime = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._fetch(name, mtime)
+                except Exception as e:
+                    errors.append(e)
+        threads = [threading.Thread(target=worker) for i in xrange(min(self.workers, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        self.stale = False
+        return self
+
+    def read(self, name):
+        if not os.path.exists('%s/%s' % (self.path, name)):
+            self._fetch(name, self._propfind(name, 0)[name][1])
+        return OmniLocalStorage.read(self, name)
+
+    def write(self, name, data):
+        """ PUT to a temporary name and MOVE it into place,
+            then update the mirror to match.
+        """
+        tmp = '.%s.%s' % (os.getpid(), name)
+        status, body, headers = self._request('PUT', tmp, data)
+        if status not in (200, 201, 204):
+            raise OmniStorage.Error('PUT %s%s: %s' % (self.url, tmp, status))
+        # the server's clock as the file was written (MOVE keeps its mtime);
+        # should it differ from getlastmodified the next `refresh` just fetches it again
+        date = parsedate_tz(headers.get('date', ''))
+        mtime = mktime_tz(date) if date else int(time.time())
+        status, body, headers = self._request('MOVE', tmp, headers={'Destination': '%s%s' % (self.url, urllib.quote(name)), 'Overwrite': 'T'})
+        if status not in (201, 204):
+            raise OmniStorage.Error('MOVE %s%s: %s' % (self.url, name, status))
+        OmniLocalStorage.write(self, name, data, mtime)
+
+    def delete(self, name):
+        status, body, headers = self._request('DELETE', name)
+        if status not in (200, 204, 404):
+            raise OmniStorage.Error('DELETE %s%s: %s' % (self.url, name, status))
+        OmniLocalStorage.delete(self, name)
+
+
+class OmniWebDAVHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ The minimal subset of WebDAV used by `OmniWebDAVStorage`. """
+    protocol_version = 'HTTP/1.1'
+    # buffer each response into a single write (flushed per request)
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self, path=None):
+        """ Map a request path onto the server's root directory. """
+        path = urllib.unquote(urlparse.urlsplit(path or self.path).path)
+        path = os.path.normpath(os.path.join(self.server.root, path.lstrip('/')))
+        if path != self.server.root and not path.startswith(self.server.root + os.sep):
+            raise OmniStorage.Error(path)
+        return path
+
+    def _send(self, status, body='', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.getheader('content-length') or 0))
+
+    def _count(self):
+        with self.server.lock:
+            self.server.requests[self.command] = self.server.requests.get(self.command, 0) + 1
+
+    def do_PROPFIND(self):
+        self._count()
+        self._body()
+        path = self._path()
+        if not os.path.exists(path):
+            return self._send(404)
+        paths = [path]
+        if os.path.isdir(path) and self.headers.getheader('depth', '1') != '0':
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        responses = []
+        for path in paths:
+            href = urllib.quote('/%s' % os.path.relpath(path, self.server.root).replace(os.sep, '/').lstrip('.'))
+            st = os.stat(path)
+            if os.path.isdir(path):
+                prop = '<D:resourcetype><D:collection/></D:resourcetype>'
+            else:
+                prop = '<D:resourcetype/><D:getcontentlength>%d</D:getcontentlength>' % st.st_size
+            prop += '<D:getlastmodified>%s</D:getlastmodified>' % formatdate(st.st_mtime, usegmt=True)
+            responses.append('<D:response><D:href>%s</D:href><D:propstat><D:prop>%s</D:prop>'
+                             '<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>' % (href, prop))
+        body = '<?xml version="1.0" encoding="utf-8"?><D:multistatus xmlns:D="DAV:">%s</D:multistatus>' % ''.join(responses)
+        self._send(207, body, {'Content-Type': 'application/xml; charset="utf-8"'})
+
+    def do_GET(self):
+        self._count()
+        path = self._path()
+        if not os.path.isfile(path):
+            return self._send(404)
+        f = open(path, 'rb')
+        try:
+            self._send(200, f.read(), {'Content-Type': 'application/octet-stream'})
+        finally:
+            f.close()
+
+    def do_PUT(self):
+        self._count()
+        path = self._path()
+        exists = os.path.exists(path)
+        f = open(path, 'wb')
+        try:
+            f.write(self._body())
+        finally:
+            f.close()
+        self._send(204 if exists else 201)
+
+    def do_MOVE(self):
+        self._count()
+        path = self._path()
+        destination = self._path(self.headers.getheader('destination'))
+        if not os.path.exists(path):
+            return self._send(404)
+        exists = os.path.exists(destination)
+        if exists and self.headers.getheader('overwrite', 'T') == 'F':
+            return self._send(412)
+        os.rename(path, destination)
+        self._send(204 if exists else 201)
+
+    def do_DELETE(self):
+        self._count()
+        path = self._path()
+        if not os.path.isfile(path):
+            return self._send(404)
+        os.remove(path)
+        self._send(204)
+
+
+class OmniWebDAVServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ In-process WebDAV stand-in serving the directory `root`,
+        for tests and benchmarks.
+            `server = OmniWebDAVServer('dbs').start()`
+    """
+    daemon_threads = True
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), OmniWebDAVHandler)
+        self.root = os.path.abspath(root)
+        # {method: count} of requests served
+        self.requests = {}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()